@@ -2,147 +2,394 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import logging
 import os
 import signal
 import sys
+import threading
 import time
-from multiprocessing import Process, Queue
-
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import salt.config
 import yaml
 from prometheus_client import start_http_server
-from prometheus_client.core import REGISTRY, GaugeMetricFamily
+from prometheus_client.core import REGISTRY, GaugeMetricFamily, Metric
+
+logger = logging.getLogger(__name__)
 
 
 def sigterm_handler(signal, frame):
-    print("Detected SIGTERM. Exiting.")
+    logger.info("Detected SIGTERM. Exiting.")
     sys.exit(0)
 
 
 signal.signal(signal.SIGTERM, sigterm_handler)
 
+# Values of rhnserveraction.status
+ACTION_STATUS_PENDING = 1
+ACTION_STATUS_COMPLETED = 2
+ACTION_STATUS_FAILED = 3
+
+LAST_DAY = "created >= NOW() - '1 day'::INTERVAL"
+
+# Tables to count, only recounted when their statistics show row changes.
+# TRUNCATE doesn't show in those statistics: all the tables are also recounted
+# every TABLE_RECOUNT_EVERY refreshes to bound how long a count can be wrong.
+TABLE_COUNTS = {
+    "channels": "rhnchannel",
+    "packages": "rhnpackage",
+    "systems": "rhnserver",
+}
+
+TABLE_RECOUNT_EVERY = 10
+
+# Number of rows inserted or deleted in a table since the statistics reset,
+# always 0 when track_counts is off
+TABLE_VERSION = (
+    "(select n_tup_ins + n_tup_del from pg_stat_user_tables"
+    " where schemaname = 'public' and relname = '{}')"
+)
+
+# Counters to get from the database, fetched at once with BATCH_COUNTS_QUERY
+# along with the versions of the TABLE_COUNTS tables.
+# The actions are all counted in a single scan of rhnserveraction.
+BATCH_COUNTS = {
+    "actions": "count(*)",
+    "actions_pending": "count(*) filter (where status = {})".format(
+        ACTION_STATUS_PENDING
+    ),
+    "actions_last_day": "count(*) filter (where {})".format(LAST_DAY),
+    "failed_actions_last_day": "count(*) filter (where {} AND status = {})".format(
+        LAST_DAY, ACTION_STATUS_FAILED
+    ),
+    "completed_actions_last_day": "count(*) filter (where {} AND status = {})".format(
+        LAST_DAY, ACTION_STATUS_COMPLETED
+    ),
+}
+BATCH_COUNTS_QUERY = "select {}, {} from rhnserveraction".format(
+    ", ".join("{} as {}".format(expr, name) for name, expr in BATCH_COUNTS.items()),
+    ", ".join(
+        "{} as {}_version".format(TABLE_VERSION.format(table), table)
+        for table in TABLE_COUNTS.values()
+    ),
+)
+
+# Salt job tag counting the jobs of the least used functions
+OTHER_JOB_FUNCTIONS = "_other"
+
+CONFIG_FILE = "config.yml"
+
+
+class Config(NamedTuple):
+    port: int = 9000
+    scrape_frequency: int = 60
+
+
+def load_config(path=CONFIG_FILE, current=None) -> Config:
+    """
+    Read and validate the exporter configuration
+
+    :param current: the configuration to keep if the file is invalid, the defaults if `None`
+    :return: the defaults if there is no configuration file
+    """
+    if current is None:
+        current = Config()
+    if not os.path.exists(path):
+        return Config()
+    try:
+        with open(path, "r") as config_file:
+            config = yaml.safe_load(config_file)
+        loaded = Config(
+            port=int(config["port"]),
+            scrape_frequency=int(config["scrape_frequency"]),
+        )
+        if loaded.scrape_frequency <= 0:
+            raise ValueError("scrape_frequency must be positive")
+        return loaded
+    except (OSError, KeyError, TypeError, ValueError, yaml.YAMLError) as error:
+        logger.error(
+            "Invalid configuration in %s, keeping %s: %s", path, current, error
+        )
+    return current
+
+
+_master_opts = None
 
-def runner_process(queue):
-    gatherer = UyuniDataGathererTasks()
-    gatherer.refresh()
-    queue.put(gatherer.get_data())
+
+def get_master_opts() -> dict:
+    """
+    Parse the Salt master configuration only once
+    """
+    global _master_opts
+    if _master_opts is None:
+        _master_opts = salt.config.master_config("/etc/salt/master")
+        _master_opts["quiet"] = True
+    return _master_opts
 
 
 class UyuniDataGatherer(object):
+    # Salt clients tend to leak memory: recreate them after this number of refreshes
+    RECYCLE_EVERY = 60
+    # Seconds to wait after a refresh that took longer than the period
+    MIN_REFRESH_GAP = 10
+
     def __init__(self):
         self.data = {}
+        self._tasks = None
+        self._refreshes = 0
         self.refresh()
 
     def __getattr__(self, item):
         return self.data[item]
 
     def refresh(self):
-        q = Queue()
-        process = Process(target=runner_process, args=(q,))
-        process.start()
-        process.join()
-        self.data = q.get()
+        if self._tasks is None or self._refreshes >= self.RECYCLE_EVERY:
+            if self._tasks is not None:
+                self._tasks.close()
+                # Never close it again if the new one can't be created
+                self._tasks = None
+            tasks = UyuniDataGathererTasks()
+            try:
+                tasks.refresh()
+            except Exception:
+                tasks.close()
+                raise
+            self._tasks = tasks
+            self._refreshes = 1
+        else:
+            # Count the failed refreshes too: recycling may be what fixes them
+            self._refreshes += 1
+            self._tasks.refresh()
+        # Swap the whole snapshot at once: readers never see partially updated data
+        self.data = self._tasks.get_data()
+
+    def start(self, frequency):
+        """
+        Refresh the data every `frequency` seconds in a background thread
+        """
+        # Can be changed while running, it is read again after each refresh
+        self.frequency = frequency
+        thread = threading.Thread(target=self._refresh_loop, daemon=True)
+        thread.start()
+        return thread
+
+    def _refresh_loop(self):
+        # Keep a steady period between refreshes, but leave the Salt master and
+        # the database some rest after one that took longer than the period
+        next_refresh = time.monotonic() + self.frequency
+        while True:
+            time.sleep(max(0, next_refresh - time.monotonic()))
+            start = time.monotonic()
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the data")
+            next_refresh = start + self.frequency
+            if time.monotonic() > next_refresh:
+                next_refresh = time.monotonic() + self.MIN_REFRESH_GAP
 
 
 class UyuniDataGathererTasks(object):
+    # Number of DB queries and Salt calls to run concurrently during a refresh
+    MAX_WORKERS = 8
+    # Number of salt_jobs series to export at most
+    MAX_JOB_FUNCTIONS = 200
+
     def __init__(self):
+        self._local = threading.local()
+        self._table_counts = {}
+        self._table_versions = {}
+        self._table_counts_age = 0
         self._init_runner()
-        self.refresh()
+        # Only once the pool exists: nothing to clean up if connecting fails
+        self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS)
 
     def _init_runner(self):
-        import salt.runner
+        # Copy the opts since the Salt clients may alter them
+        self.master_opts = dict(get_master_opts())
+        pg = self.master_opts["postgres"]
+        self.pg_pool = psycopg2.pool.ThreadedConnectionPool(
+            1,
+            self.MAX_WORKERS,
+            user=pg["user"],
+            password=pg["pass"],
+            host=pg["host"],
+            port=pg["port"],
+            dbname=pg["db"],
+        )
+
+    def close(self):
+        self._executor.shutdown()
+        self.pg_pool.closeall()
+
+    @property
+    def runner(self):
+        # RunnerClient is not guaranteed to be thread-safe, use one per worker thread
+        runner = getattr(self._local, "runner", None)
+        if runner is None:
+            import salt.runner
 
-        self.master_opts = salt.config.master_config("/etc/salt/master")
-        self.master_opts["quiet"] = True
-        self.runner = salt.runner.RunnerClient(self.master_opts)
+            runner = salt.runner.RunnerClient(self.master_opts)
+            self._local.runner = runner
+        return runner
 
     def execute_db_query(self, query: str) -> list:
-        start = time.time()
-        kwargs = {
-            "user": self.master_opts["postgres"]["user"],
-            "password": self.master_opts["postgres"]["pass"],
-            "host": self.master_opts["postgres"]["host"],
-            "port": self.master_opts["postgres"]["port"],
-            "maintenance_db": self.master_opts["postgres"]["db"],
-        }
-        ret = self.runner.cmd("salt.cmd", ["postgres.psql_query", query], kwarg=kwargs)
-        print(
-            "* execute db query {} - took: {} seconds".format(
-                query, time.time() - start
-            )
-        )
+        conn = self.pg_pool.getconn()
+        try:
+            conn.autocommit = True
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                cursor.execute(query)
+                ret = cursor.fetchall()
+        except psycopg2.Error:
+            # Don't give a possibly broken connection back to the pool
+            self.pg_pool.putconn(conn, close=True)
+            raise
+        self.pg_pool.putconn(conn)
         return ret
 
+    def execute_db_queries_batch(self) -> dict:
+        """
+        Get all the Uyuni counters, in a single query unless the tables changed
+        """
+        row = self.execute_db_query(BATCH_COUNTS_QUERY)[0]
+        counts = {name: int(row[name]) for name in BATCH_COUNTS}
+
+        # Counting the big tables takes a full scan: skip it if no row was
+        # added or removed since the previous count. Without usable statistics
+        # or after a while, count anyway.
+        self._table_counts_age += 1
+        if self._table_counts_age >= TABLE_RECOUNT_EVERY:
+            self._table_counts_age = 0
+            self._table_versions = {}
+        changed = {
+            name: table
+            for name, table in TABLE_COUNTS.items()
+            if not row[table + "_version"]
+            or row[table + "_version"] != self._table_versions.get(table)
+        }
+        if changed:
+            tables_row = self.execute_db_query(
+                "select {}".format(
+                    ", ".join(
+                        "(select count(*) from {}) as {}".format(table, name)
+                        for name, table in changed.items()
+                    )
+                )
+            )[0]
+            for name, table in changed.items():
+                self._table_counts[name] = int(tables_row[name])
+                self._table_versions[table] = row[table + "_version"]
+        counts.update(self._table_counts)
+        return counts
+
     def list_active_salt_jobs(self) -> dict:
-        start = time.time()
         ret = self.runner.cmd("jobs.active")
-        print("* list_active_salt_jobs took: {} seconds".format(time.time() - start))
         return ret
 
     def find_salt_jobs(self) -> dict:
-        start = time.time()
-        ret = self.runner.cmd("jobs.list_jobs")
-        print("* find_salt_jobs took: {} seconds".format(time.time() - start))
+        # The job cache may keep more than a day of jobs depending on keep_jobs.
+        # The jobs start times are in the master local time unless utc_jid is set,
+        # the container gets the host timezone for this.
+        if self.master_opts.get("utc_jid"):
+            now = datetime.utcnow()
+        else:
+            now = datetime.now()
+        start_time = now - timedelta(days=1)
+        ret = self.runner.cmd(
+            "jobs.list_jobs", kwarg={"start_time": start_time.isoformat()}
+        )
         return ret
 
-    def test_ping(self) -> dict:
-        start = time.time()
-        self.runner.cmd("salt.cmd", ["test.ping"])
-        end = time.time()
-        print("* test_ping took: {} seconds".format(end - start))
-        return end - start
+    def test_ping(self) -> float:
+        """
+        Time a trivial runner call
+
+        Runners run inside the exporter process and never reach the Salt master
+        daemon: this reflects how loaded the host is, not how responsive the
+        master is.
+        """
+        start = time.monotonic()
+        # salt.cmd would load all the execution modules for a test.ping
+        self.runner.cmd("test.arg", ["ping"])
+        return time.monotonic() - start
 
     def salt_alived_minions(self) -> list:
-        start = time.time()
         ret = self.runner.cmd("manage.alived")
-        print("* salt manage.alived took: {} seconds".format(time.time() - start))
         return ret
 
+    @staticmethod
+    def _timed(timings, name, func, *args):
+        start = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            timings[name] = time.monotonic() - start
+
+    @staticmethod
+    def _salt_job_tag(job: dict) -> str:
+        function = job["Function"]
+        args = job["Arguments"]
+        if function == "state.apply" and args:
+            arg = args[0]
+            if isinstance(arg, dict) and arg.get("mods"):
+                return f"{function}_{'_'.join(arg['mods'])}"
+            return f"{function}_{arg}"
+        return function
+
     def summarize_salt_jobs(self, jobs: dict) -> dict:
-        summary = {
-            "functions": {},
-        }
-        for jid in jobs:
-            if jobs[jid]["Function"] == "state.apply" and jobs[jid]["Arguments"]:
-                if isinstance(jobs[jid]["Arguments"][0], dict) and jobs[jid][
-                    "Arguments"
-                ][0].get("mods"):
-                    tag = "{}_{}".format(
-                        jobs[jid]["Function"],
-                        "_".join(jobs[jid]["Arguments"][0]["mods"]),
-                    )
-                else:
-                    tag = "{}_{}".format(
-                        jobs[jid]["Function"], jobs[jid]["Arguments"][0]
-                    )
-            else:
-                tag = jobs[jid]["Function"]
-            summary["functions"].setdefault(tag, 0)
-            summary["functions"][tag] += 1
-        return summary
+        functions = Counter(self._salt_job_tag(job) for job in jobs.values())
+        if len(functions) > self.MAX_JOB_FUNCTIONS:
+            # The state.apply mods make the tags unbounded, group the least used ones
+            top = Counter(dict(functions.most_common(self.MAX_JOB_FUNCTIONS - 1)))
+            top[OTHER_JOB_FUNCTIONS] = sum(functions.values()) - sum(top.values())
+            functions = top
+        return {"functions": functions}
 
     def refresh(self):
-        self.channels = self.execute_db_query("select count(*) from rhnchannel")
-        self.packages = self.execute_db_query("select count(*) from rhnpackage")
-        self.systems = self.execute_db_query("select count(*) from rhnserver")
-        self.actions = self.execute_db_query("select count(*) from rhnserveraction")
-        self.actions_pending = self.execute_db_query(
-            "select count(*) from rhnserveraction WHERE status = 1"
-        )
-        self.actions_last_day = self.execute_db_query(
-            "select * from rhnserveraction WHERE created >= NOW() - '1 day'::INTERVAL"
+        # All the queries and Salt calls are independent and I/O bound
+        tasks = {
+            "counts": (self.execute_db_queries_batch,),
+            "salt_jobs": (self.find_salt_jobs,),
+            "active_salt_jobs": (self.list_active_salt_jobs,),
+            "master_test_ping": (self.test_ping,),
+            "zeromq_alived_minions": (self.salt_alived_minions,),
+        }
+        start = time.monotonic()
+        timings = {}
+        futures = {
+            self._executor.submit(self._timed, timings, name, *task): name
+            for name, task in tasks.items()
+        }
+        results = {futures[future]: future.result() for future in as_completed(futures)}
+
+        counts = results["counts"]
+        self.channels = counts["channels"]
+        self.packages = counts["packages"]
+        self.systems = counts["systems"]
+        self.actions = counts["actions"]
+        self.actions_pending = counts["actions_pending"]
+        self.actions_last_day = counts["actions_last_day"]
+        self.failed_actions_last_day = counts["failed_actions_last_day"]
+        self.completed_actions_last_day = counts["completed_actions_last_day"]
+        self.salt_jobs = self.summarize_salt_jobs(results["salt_jobs"])
+        self.active_salt_jobs = self.summarize_salt_jobs(results["active_salt_jobs"])
+        self.master_test_ping = results["master_test_ping"]
+        self.zeromq_alived_minions = results["zeromq_alived_minions"]
+
+        logger.info(
+            "Refresh took %.3f seconds (%s)",
+            time.monotonic() - start,
+            ", ".join(
+                "{}: {:.3f}".format(name, duration)
+                for name, duration in sorted(timings.items())
+            ),
         )
-        self.failed_actions_last_day = [
-            x for x in self.actions_last_day if x["status"] == "3"
-        ]
-        self.completed_actions_last_day = [
-            x for x in self.actions_last_day if x["status"] == "2"
-        ]
-        self.salt_jobs = self.summarize_salt_jobs(self.find_salt_jobs())
-        self.active_salt_jobs = self.summarize_salt_jobs(self.list_active_salt_jobs())
-        self.master_test_ping = self.test_ping()
-        self.zeromq_alived_minions = self.salt_alived_minions()
-        sys.stdout.flush()
 
     def get_data(self):
         return {
@@ -164,35 +411,44 @@ class UyuniDataGathererTasks(object):
 class UyuniMetricsCollector(object):
     def __init__(self, gatherer):
         self.gatherer = gatherer
+        self._cache = []
+        self._cache_data = None
 
     def collect(self):
-        channels = self.gatherer.channels
-        packages = self.gatherer.packages
-        systems = self.gatherer.systems
-        actions = self.gatherer.actions
-        actions_pending = self.gatherer.actions_pending
-        actions_last_day = self.gatherer.actions_last_day
-        failed_actions_last_day = self.gatherer.failed_actions_last_day
-        completed_actions_last_day = self.gatherer.completed_actions_last_day
-        salt_jobs = self.gatherer.salt_jobs
-        active_salt_jobs = self.gatherer.active_salt_jobs
-        master_test_ping = self.gatherer.master_test_ping
-        zeromq_alived_minions = self.gatherer.zeromq_alived_minions
-
-        gauge = GaugeMetricFamily(
-            "salt_jobs", "Salt jobs in the last 24 hours", labels=["name", "fun"]
-        )
-        for func in active_salt_jobs["functions"]:
-            gauge.add_metric(
-                ["salt_jobs_active_{}_total".format(func), func],
-                active_salt_jobs["functions"][func],
-            )
-        for func in salt_jobs["functions"]:
-            gauge.add_metric(
-                ["salt_jobs_{}_total".format(func), func], salt_jobs["functions"][func]
-            )
+        # The data snapshot is only replaced on refresh,
+        # no need to rebuild the metrics on each scrape
+        data = self.gatherer.data
+        if data is not self._cache_data:
+            self._cache = list(self._build_metrics(data))
+            self._cache_data = data
+        yield from self._cache
+
+    def _build_metrics(self, data):
+        channels = data["channels"]
+        packages = data["packages"]
+        systems = data["systems"]
+        actions = data["actions"]
+        actions_pending = data["actions_pending"]
+        actions_last_day = data["actions_last_day"]
+        failed_actions_last_day = data["failed_actions_last_day"]
+        completed_actions_last_day = data["completed_actions_last_day"]
+        salt_jobs = data["salt_jobs"]
+        active_salt_jobs = data["active_salt_jobs"]
+        master_test_ping = data["master_test_ping"]
+        zeromq_alived_minions = data["zeromq_alived_minions"]
+
+        # Add the samples directly for the metrics with many series,
+        # GaugeMetricFamily.add_metric() would zip the labels for each of them
+        gauge = Metric("salt_jobs", "Salt jobs in the last 24 hours", "gauge")
+        for func, count in salt_jobs["functions"].items():
+            gauge.add_sample("salt_jobs", {"fun": func}, count)
         yield gauge
 
+        active_gauge = Metric("salt_jobs_active", "Running Salt jobs", "gauge")
+        for func, count in active_salt_jobs["functions"].items():
+            active_gauge.add_sample("salt_jobs_active", {"fun": func}, count)
+        yield active_gauge
+
         gauge2 = GaugeMetricFamily(
             "salt_master_stats",
             "Some stats from Salt master",
@@ -202,57 +458,65 @@ class UyuniMetricsCollector(object):
         gauge2.add_metric(
             ["salt_master_zeromq_alived_minions_total"], len(zeromq_alived_minions)
         )
-        for minion in zeromq_alived_minions:
-            gauge2.add_metric(["salt_master_zeromq_alived_minion_{}".format(minion)], 1)
         yield gauge2
 
+        alived_minions = Metric(
+            "salt_master_zeromq_alived_minion",
+            "Minions connected to the Salt master ZeroMQ bus",
+            "gauge",
+        )
+        for minion in zeromq_alived_minions:
+            alived_minions.add_sample(
+                "salt_master_zeromq_alived_minion", {"minion": minion}, 1
+            )
+        yield alived_minions
+
         gauge3 = GaugeMetricFamily(
             "uyuni_summary",
             "Some relevant metrics in the context of Uyuni",
             labels=["name"],
         )
-        gauge3.add_metric(["uyuni_summary_channels_total"], int(channels[0]["count"]))
-        gauge3.add_metric(["uyuni_summary_packages_total"], int(packages[0]["count"]))
-        gauge3.add_metric(["uyuni_summary_systems_total"], int(systems[0]["count"]))
+        gauge3.add_metric(["uyuni_summary_channels_total"], channels)
+        gauge3.add_metric(["uyuni_summary_packages_total"], packages)
+        gauge3.add_metric(["uyuni_summary_systems_total"], systems)
+        gauge3.add_metric(["uyuni_summary_actions_pending_total"], actions_pending)
+        gauge3.add_metric(["uyuni_summary_actions_total"], actions)
         gauge3.add_metric(
-            ["uyuni_summary_actions_pending_total"], int(actions_pending[0]["count"])
-        )
-        gauge3.add_metric(["uyuni_summary_actions_total"], int(actions[0]["count"]))
-        gauge3.add_metric(
-            ["uyuni_summary_actions_last_24hours_total"], len(actions_last_day)
+            ["uyuni_summary_actions_last_24hours_total"], actions_last_day
         )
         gauge3.add_metric(
             ["uyuni_summary_actions_failed_last_24hours_total"],
-            len(failed_actions_last_day),
+            failed_actions_last_day,
         )
         gauge3.add_metric(
             ["uyuni_summary_actions_completed_last_24hours_total"],
-            len(completed_actions_last_day),
+            completed_actions_last_day,
         )
         yield gauge3
 
 
 def main():
-    print("Uyuni Health Exporter started")
-    port = 9000
-    frequency = 60
-    if os.path.exists("config.yml"):
-        with open("config.yml", "r") as config_file:
-            try:
-                config = yaml.safe_load(config_file)
-                port = int(config["port"])
-                frequency = config["scrape_frequency"]
-            except yaml.YAMLError as error:
-                print(error)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    logger.info("Uyuni Health Exporter started")
+    config = load_config()
 
-    start_http_server(port)
+    start_http_server(config.port)
     uyuni_data_gatherer = UyuniDataGatherer()
     REGISTRY.register(UyuniMetricsCollector(uyuni_data_gatherer))
-    print("Uyuni Health Exporter is ready")
-    while True:
-        # period between collection
-        time.sleep(frequency)
-        uyuni_data_gatherer.refresh()
+
+    def sighup_handler(signal, frame):
+        nonlocal config
+        # The port can't be changed without a restart
+        config = load_config(current=config)._replace(port=config.port)
+        logger.info("Reloaded configuration: %s", config)
+        uyuni_data_gatherer.frequency = config.scrape_frequency
+
+    signal.signal(signal.SIGHUP, sighup_handler)
+
+    logger.info("Uyuni Health Exporter is ready")
+    uyuni_data_gatherer.start(config.scrape_frequency).join()
 
 
 if __name__ == "__main__":
@@ -2,14 +2,19 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
-import io
+import hashlib
 import json
 import os
 import os.path
+import pwd
+import random
 import re
-import subprocess
+import shutil
+import tempfile
+import threading
 import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from json.decoder import JSONDecodeError
 from time import sleep
@@ -39,11 +44,18 @@ from uyuni_health_check.metrics import (
     show_uyuni_summary,
 )
 from uyuni_health_check.util import (
+    CACHE_DIR,
+    PACKAGE_DIR,
     HealthException,
+    http_get,
+    http_session,
+    pipe_to_server,
     podman,
     render_promtail_cfg,
     render_supportconfig_exporter_cfg,
+    scp,
     ssh_call,
+    ssh_close,
 )
 
 # Update this number if adding more targets to the promtail config
@@ -52,8 +64,73 @@ PROMTAIL_TARGETS = 6
 # Max number of seconds to wait for Loki to be ready
 LOKI_WAIT_TIMEOUT = 120
 
-console = Console()
+# Seconds to wait for quick queries on the server and for image builds or transfers
+PODMAN_QUERY_TIMEOUT = 30
+PODMAN_IMAGE_TIMEOUT = 600
+
+# Configuration files shipped with the package
+GRAFANA_CFG = os.path.join(PACKAGE_DIR, "grafana")
+PROMETHEUS_CFG = os.path.join(PACKAGE_DIR, "prometheus", "prometheus.yml")
+LOKI_CFG = os.path.join(PACKAGE_DIR, "loki", "config.yaml")
+
+# Label storing the digest of the build context an image was built from
+IMAGE_VERSION_LABEL = "uyuni-health-check.version"
+
+# Release of Loki to get the promtail binary from
+LOKI_VERSION = "v2.9.2"
+LOKI_RELEASE_URL = f"https://github.com/grafana/loki/releases/download/{LOKI_VERSION}"
+
+# Size of the blocks to write to disk when downloading a file
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of tries to get a download matching its published checksum
+DOWNLOAD_ATTEMPTS = 2
+
+# Bounds of the exponential backoff between two Loki readiness polls in seconds
+LOKI_POLL_MIN_DELAY = 0.1
+LOKI_POLL_MAX_DELAY = 5.0
+
+# Print postgresql and the spacewalk services on the first line,
+# then the status of each of them, one per line in the same order
+SERVICES_STATUS_SCRIPT = """
+services=$(spacewalk-service list) || exit $?
+services="postgresql $(echo "$services" | while read -r unit _; do
+    case "$unit" in *.service) echo "${unit%.service}" ;; esac
+done)"
+echo $services
+# is-active fails if any of the services isn't active
+systemctl is-active $services || true
+"""
+
+# Promtail metrics to parse in a single pass over the raw response bytes
+PROMTAIL_METRICS_RE = re.compile(
+    rb"^(?:promtail_targets_active_total (?P<active>[0-9]+)"
+    rb"|promtail_files_active_total (?P<active_files>[0-9]+)"
+    rb'|promtail_stream_lag_seconds{filename="(?P<filename>[^"]+)"[^}]*} (?P<lag>[0-9.]+))',
+    re.MULTILINE,
+)
+
+# Most logs are status messages: no need to guess syntax to highlight in them
+console = Console(highlight=False, log_path=False)
+# Hints to show in the results, added from several threads
 _hints = []
+_hints_lock = threading.Lock()
+# (server, image) pairs known to exist: images don't vanish during a run
+_existing_images = set()
+# Names of the running containers per server, listed once from several threads
+_running_containers = {}
+_running_containers_lock = threading.Lock()
+
+
+def add_hint(msg):
+    """
+    Log a hint and add it to the results unless it is already there
+    """
+    with _hints_lock:
+        if msg in _hints:
+            return
+        _hints.append(msg)
+    console.log(msg)
 
 
 def wait_loki_init(server, verbose=False):
@@ -65,56 +142,54 @@ def wait_loki_init(server, verbose=False):
     """
     metrics = None
     timeouted = False
-    start_time = time.time()
-    ready = False
-
-    # Wait for promtail to be ready
-    # TODO Add a timeout here in case something went really bad
-    # TODO checking the lags won't work when working on older logs,
-    # we could try to compare the positions with the size of the files in such a case
-    while (
-        not metrics
-        or metrics["active"] < PROMTAIL_TARGETS
-        or (not metrics["lags"] and metrics["active_files"] == 0)
-        or any([v >= 10 for v in metrics["lags"].values()])
-        or (metrics["lags"] and metrics["active_files"])
-        or not ready
-        and not timeouted
-    ):
-        sleep(1)
-        response = requests.get(f"http://{server}:9081/metrics")
-        if response.status_code == 200:
-            content = response.content.decode()
-            active = re.findall("promtail_targets_active_total ([0-9]+)", content)
-            active_files = re.findall("promtail_files_active_total ([0-9]+)", content)
-            lags = re.findall(
-                'promtail_stream_lag_seconds{filename="([^"]+)".*} ([0-9.]+)', content
-            )
-            metrics = {
-                "lags": {row[0]: float(row[1]) for row in lags},
-                "active": int(active[0]) if active else 0,
-                "active_files": int(active_files[0]) if active_files else 0,
-            }
-
-        # check if loki is ready
-        response = requests.get(f"http://{server}:3100/ready")
-        if response.status_code == 200:
-            content = response.content.decode()
-            if content == "ready\n":
-                ready = True
-
-        # check if promtail is ready
-        response = requests.get(f"http://{server}:9081/ready")
-        if response.status_code == 200:
-            content = response.content.decode()
-            if content == "Ready":
-                ready = True
+    deadline = time.monotonic() + LOKI_WAIT_TIMEOUT
+    caught_up = False
+    delay = None
+
+    metrics_url = f"http://{server}:9081/metrics"
+    # Readiness probe URL and expected answer for loki and promtail.
+    # Once a service is ready it stays so: drop it to stop probing it.
+    pending_probes = {
+        f"http://{server}:3100/ready": "ready\n",
+        f"http://{server}:9081/ready": "Ready",
+    }
+    with http_session() as session, ThreadPoolExecutor(
+        max_workers=len(pending_probes)
+    ) as executor:
+        # Wait for promtail to be ready
+        # TODO checking the lags won't work when working on older logs,
+        # we could try to compare the positions with the size of the files in such a case
+        while pending_probes and not timeouted:
+            # No need to wait before the first poll
+            if delay is None:
+                delay = LOKI_POLL_MIN_DELAY
             else:
-                ready = False
-        # check timeout
-        if (time.time() - start_time) > LOKI_WAIT_TIMEOUT:
-            timeouted = True
-    if timeouted:
+                # Add some jitter to not poll in lockstep with other runs
+                sleep(delay * random.uniform(1, 1.25))
+                delay = min(delay * 2, LOKI_POLL_MAX_DELAY)
+
+            if not caught_up:
+                previous_metrics = metrics
+                metrics_response = http_get(session, metrics_url)
+                if metrics_response is not None and metrics_response.status_code == 200:
+                    metrics = parse_promtail_metrics(metrics_response.content)
+                    if _promtail_progressed(previous_metrics, metrics):
+                        # Things are moving, poll more often again
+                        delay = LOKI_POLL_MIN_DELAY
+                caught_up = promtail_caught_up(metrics)
+
+            # No need to ask loki and promtail until the logs are ingested
+            if caught_up:
+                urls = list(pending_probes)
+                responses = executor.map(http_get, [session] * len(urls), urls)
+                for url, response in zip(urls, responses):
+                    if _answers(response, pending_probes[url]):
+                        del pending_probes[url]
+
+            # check timeout
+            if time.monotonic() > deadline:
+                timeouted = True
+    if pending_probes:
         raise HealthException(
             "[red bold]Timeout has been reached waiting for Loki and promtail. Something unexpected may happen. Please check and try again."
         )
@@ -122,81 +197,190 @@ def wait_loki_init(server, verbose=False):
         console.log("[bold]Loki and promtail are now ready to receive requests")
 
 
-def build_image(name, image_path=None, verbose=False, server=None):
+def promtail_caught_up(metrics):
+    """
+    Check if the promtail metrics show that all the targets are read
+    """
+    return bool(
+        metrics
+        and metrics["active"] >= PROMTAIL_TARGETS
+        and (metrics["lags"] or metrics["active_files"] != 0)
+        and all(v < 10 for v in metrics["lags"].values())
+        and not (metrics["lags"] and metrics["active_files"])
+    )
+
+
+def _answers(response, content):
+    """
+    Check if a readiness probe got the expected answer
+    """
+    return (
+        response is not None
+        and response.status_code == 200
+        and response.content.decode() == content
+    )
+
+
+def parse_promtail_metrics(content):
+    """
+    Extract the values needed to check promtail progress from its metrics
+    """
+    metrics = {"lags": {}, "active": 0, "active_files": 0}
+    for match in PROMTAIL_METRICS_RE.finditer(content):
+        kind = match.lastgroup
+        if kind == "lag":
+            metrics["lags"][match.group("filename").decode()] = float(
+                match.group("lag")
+            )
+        else:
+            metrics[kind] = int(match.group(kind))
+    return metrics
+
+
+def _promtail_progressed(previous, current):
+    """
+    Check if promtail has more active targets or less lag than at the previous poll
+    """
+    if not previous:
+        return True
+    return current["active"] > previous["active"] or max(
+        current["lags"].values(), default=0
+    ) < max(previous["lags"].values(), default=0)
+
+
+def build_context_version(image_path):
+    """
+    Compute a digest of the files in an image build context
+
+    :param image_path: the build context folder, relative to this package
+    """
+    context = os.path.join(PACKAGE_DIR, image_path)
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(context):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, context).encode())
+            with open(path, "rb") as fd:
+                digest.update(fd.read())
+    return digest.hexdigest()
+
+
+def build_image(name, image_path=None, verbose=False, server=None, version=None):
     """
     Build a container image
+
+    :param version: value of the version label to stamp on the image
     """
-    expanded_path = os.path.join(os.path.dirname(__file__), image_path or name)
+    expanded_path = os.path.join(PACKAGE_DIR, image_path or name)
+    labels = ["--label", f"{IMAGE_VERSION_LABEL}={version}"] if version else []
     process = podman(
-        ["build", "-t", name, expanded_path],
+        ["build", "-t", name] + labels + [expanded_path],
         console=console if verbose else None,
         server=server,
+        timeout=PODMAN_IMAGE_TIMEOUT,
     )
     if process.returncode != 0:
         raise HealthException(f"Failed to build {name} image")
+    _existing_images.add(_image_key(server, name))
 
 
-def pod_exists(pod, server=None):
+def image_inspect(image, fmt, server=None):
     """
-    Check if the image pod is up and running
+    Get some data on an image using a podman inspect format
+
+    :return: the formatted output or `None` if the image doesn't exist
     """
-    return (
-        podman(["pod", "list", "--quiet", f"-fname={pod}"], server=server)
-        .stdout.read()
-        .strip()
-        != ""
+    try:
+        process = podman(
+            ["image", "inspect", "--format", fmt, image],
+            server=server,
+            timeout=PODMAN_QUERY_TIMEOUT,
+        )
+    except HealthException:
+        # podman fails with the same error code for missing images and other errors
+        return None
+    if process.returncode != 0:
+        return None
+    return process.stdout.strip()
+
+
+def image_id(image, server=None):
+    """
+    Get the ID of an image
+
+    :return: the image ID or `None` if the image doesn't exist
+    """
+    return image_inspect(image, "{{.Id}}", server=server)
+
+
+def image_version(image, server=None):
+    """
+    Get the version label stamped on an image at build time
+    """
+    return image_inspect(
+        image, f'{{{{index .Labels "{IMAGE_VERSION_LABEL}"}}}}', server=server
     )
 
 
-def image_exists(image, server=None):
+def pod_exists(pod, server=None):
     """
-    Check if the image is present in podman images result
+    Check if the pod exists
     """
-    return (
-        podman(["images", "--quiet", "-f", f"reference={image}"], server=server)
-        .stdout.read()
-        .strip()
-        != ""
+    process = podman(
+        ["pod", "exists", pod], server=server, timeout=PODMAN_QUERY_TIMEOUT
     )
+    return process.returncode == 0
 
 
-def check_postgres_service(server):
+def image_exists(image, server=None):
     """
-    Check that postgresql service is running
+    Check if the image is present in podman storage
     """
-    try:
-        process = ssh_call(server, ["systemctl", "status", "postgresql"])
-        if process.returncode != 0:
-            msg = "[bold red]WARNING: 'postgresql' service is NOT running!"
-            _hints.append(msg)
-            console.log(msg)
-        else:
-            console.log("[green]The postgresql service is running")
-    except OSError:
-        raise HealthException(
-            f"The specified server '{server}' is not and Uyuni / SUSE Manager server!"
-        )
+    if _image_key(server, image) in _existing_images:
+        return True
+    exists = image_id(image, server) is not None
+    if exists:
+        _existing_images.add(_image_key(server, image))
+    return exists
+
+
+def _image_key(server, image):
+    # Locally built images can be referred to with or without the localhost/ prefix
+    if image.startswith("localhost/"):
+        image = image[len("localhost/") :]
+    return (server, image)
 
 
 def check_spacewalk_services(server, verbose=False):
     """
-    Check that spacewalk services are running
+    Check that spacewalk and postgresql services are running
+
+    All the services are checked by a single command on the server
     """
     try:
-        process = ssh_call(server, ["spacewalk-service", "list"])
+        process = ssh_call(
+            server, ["sh", "-c", SERVICES_STATUS_SCRIPT], timeout=PODMAN_QUERY_TIMEOUT
+        )
         if process.returncode != 0:
             raise HealthException("Failed to check spacewalk services")
 
-        services = re.findall(r"(.+)\.service .*", process.stdout.read())
+        lines = process.stdout.splitlines()
+        services = lines[0].split() if lines else []
+        if len(lines) != len(services) + 1:
+            raise HealthException("Failed to check spacewalk services")
+        statuses = dict(zip(services, lines[1:]))
+        if statuses.pop("postgresql") != "active":
+            add_hint("[bold red]WARNING: 'postgresql' service is NOT running!")
+        else:
+            console.log("[green]The postgresql service is running")
+
         if verbose:
-            console.log(f"Spacewalk services: {services}")
+            console.log(f"Spacewalk services: {list(statuses)}")
         all_running = True
-        for service in services:
-            process = ssh_call(server, ["systemctl", "status", service])
-            if process.returncode != 0:
-                msg = f"[bold red]WARNING: '{service}' service is NOT running!"
-                console.log(msg)
-                _hints.append(msg)
+        for service, status in statuses.items():
+            if status != "active":
+                add_hint(f"[bold red]WARNING: '{service}' service is NOT running!")
                 all_running = False
         if all_running:
             console.log("[green]All spacewalk services are running")
@@ -207,12 +391,125 @@ def check_spacewalk_services(server, verbose=False):
         )
 
 
+def get_user_ids(user, server=None):
+    """
+    Get the UID and GID of a user on the server
+
+    :return: the (uid, gid) tuple or `None` if the user doesn't exist
+    """
+    if not server:
+        try:
+            entry = pwd.getpwnam(user)
+        except KeyError:
+            return None
+        return str(entry.pw_uid), str(entry.pw_gid)
+
+    process = ssh_call(server, ["getent", "passwd", user])
+    # getent exits with 2 when the key is not found
+    if process.returncode == 2:
+        return None
+    elif process.returncode != 0:
+        raise HealthException(f"Failed to get {user} user IDs: {process.stderr}")
+    # name:password:uid:gid:gecos:home:shell
+    fields = process.stdout.strip().split(":")
+    return fields[2], fields[3]
+
+
 def container_is_running(name, server=None):
     """
-    Check if a container with a given name is running in podman
+    Check if a container with a given name was running in podman
+
+    The running containers are listed only once per server: this tells if the
+    container was running before the tool started any.
+    """
+    with _running_containers_lock:
+        if server not in _running_containers:
+            process = podman(
+                ["ps", "--format", "{{.Names}}", "-f", "status=running"],
+                server=server,
+                timeout=PODMAN_QUERY_TIMEOUT,
+            )
+            _running_containers[server] = set(process.stdout.split())
+    return name in _running_containers[server]
+
+
+def fetch_loki_binary(image):
+    """
+    Get the binary from the Loki release, downloading it only if not cached yet
+
+    :param image: the name of the Loki tool, like promtail
+    :return: the path to the binary in the cache
+    """
+    binary = f"{image}-linux-amd64"
+    # The version is part of the cache key so that bumping it invalidates the cache
+    cache_dir = os.path.join(CACHE_DIR, f"{image}-{LOKI_VERSION}")
+    cached_binary = os.path.join(cache_dir, binary)
+    if os.path.exists(cached_binary):
+        return cached_binary
+
+    # Fetch the binary from the release, reusing the connection after the checksums
+    archive_name = f"{binary}.zip"
+    # Write the archive to disk while downloading instead of buffering it in memory
+    with requests.Session() as session, tempfile.TemporaryFile(
+        suffix=".zip"
+    ) as archive:
+        expected_digest = fetch_loki_checksum(session, archive_name)
+        for attempt in range(DOWNLOAD_ATTEMPTS):
+            if attempt:
+                console.log(f"[yellow]Retrying the {image} download...")
+                sleep(2**attempt)
+            archive.seek(0)
+            archive.truncate()
+            digest = download(session, f"{LOKI_RELEASE_URL}/{archive_name}", archive)
+            if digest == expected_digest:
+                break
+        else:
+            raise HealthException(f"Checksum mismatch for the {image} download")
+
+        # Rename once complete to never leave a truncated binary in the cache
+        os.makedirs(cache_dir, exist_ok=True)
+        partial_binary = f"{cached_binary}.part"
+        with zipfile.ZipFile(archive) as zip:
+            with zip.open(binary) as src, open(partial_binary, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        os.replace(partial_binary, cached_binary)
+    return cached_binary
+
+
+def fetch_loki_checksum(session, filename):
+    """
+    Get the SHA-256 digest of a Loki release file from the published checksums
+    """
+    url = f"{LOKI_RELEASE_URL}/SHA256SUMS"
+    try:
+        response = session.get(url, timeout=60)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as err:
+        raise HealthException(f"Failed to download the Loki checksums: {err}")
+    for line in response.text.splitlines():
+        # "<digest>  <name>", with a * before the name for binary mode
+        fields = line.split()
+        if len(fields) == 2 and fields[1].lstrip("*") == filename:
+            return fields[0].lower()
+    raise HealthException(f"No published checksum for {filename}")
+
+
+def download(session, url, output):
     """
-    process = podman(["ps", "--quiet", "-f", f"name={name}"], server=server)
-    return process.stdout.read() != ""
+    Stream an URL to a file object
+
+    :return: the hex SHA-256 digest of the downloaded data
+    """
+    digest = hashlib.sha256()
+    try:
+        with session.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                output.write(chunk)
+    except requests.exceptions.RequestException as err:
+        raise HealthException(f"Failed to download {url}: {err}")
+    return digest.hexdigest()
 
 
 def build_loki_image(image, verbose=False, server=None):
@@ -220,13 +517,9 @@ def build_loki_image(image, verbose=False, server=None):
         console.log(f"[yellow]Skipped as the {image} image is already present")
         return
 
-    # Fetch the logcli binary from the latest release
-    url = f"https://github.com/grafana/loki/releases/download/v2.9.2/{image}-linux-amd64.zip"
-    #    url = f"https://github.com/grafana/loki/releases/download/v2.8.6/{image}-linux-amd64.zip"
-    dest_dir = os.path.join(os.path.dirname(__file__), image)
-    response = requests.get(url)
-    zip = zipfile.ZipFile(io.BytesIO(response.content))
-    zip.extract(f"{image}-linux-amd64", dest_dir)
+    binary = f"{image}-linux-amd64"
+    dest_dir = os.path.join(PACKAGE_DIR, image)
+    shutil.copy2(fetch_loki_binary(image), os.path.join(dest_dir, binary))
     build_image(image, verbose=verbose, server=server)
     console.log(f"[green]The {image} image was built successfully")
 
@@ -237,21 +530,35 @@ def transfer_image(server, image):
 
     :param server: the server to transfer the image to
     """
-    # Save, deploy and load the image
-    # TODO Handle errors
-    local_image_path = f"/tmp/{image}.tar"
-    if os.path.exists(local_image_path):
-        # podman doesn't like if the image is already present
-        os.unlink(local_image_path)
-
-    console.log(f"[bold]Saving the {image} image...")
-    podman(["save", "--output", local_image_path, image])
+    # Both podman image scp and save/load keep the image ID
+    local_id = image_id(image)
+    if local_id and image_id(image, server) == local_id:
+        console.log(f"[yellow]Skipped as {server} already has the {image} image")
+        _existing_images.add(_image_key(server, image))
+        return
 
+    # Podman 4+ can stream the image to the server without intermediate tarball
     console.log(f"[bold]Transfering the {image} image to {server}...")
-    subprocess.run(["scp", "-q", local_image_path, f"{server}:/tmp/"])
-
-    console.log(f"[bold]Loading the {image} image on {server}...")
-    podman(["load", "--input", f"/tmp/{image}.tar"], server)
+    try:
+        process = podman(
+            ["image", "scp", image, f"{server}::"], timeout=PODMAN_IMAGE_TIMEOUT
+        )
+        if process.returncode == 0:
+            _existing_images.add(_image_key(server, image))
+            return
+    except HealthException:
+        pass
+    console.log("[yellow]Failed to use podman image scp, using podman save and load")
+
+    # Stream the saved image to podman load on the server without temporary files
+    if not pipe_to_server(
+        ["podman", "save", image],
+        server,
+        ["podman", "load"],
+        timeout=PODMAN_IMAGE_TIMEOUT,
+    ):
+        raise HealthException(f"Failed to transfer the {image} image to {server}")
+    _existing_images.add(_image_key(server, image))
 
 
 def prepare_exporter(server, verbose=False, supportconfig_path=None):
@@ -269,10 +576,12 @@ def prepare_exporter(server, verbose=False, supportconfig_path=None):
         exporter_dir = "exporter"
 
     console.log(f"[bold]Building {exporter_name} image")
-    if image_exists(f"{exporter_name}"):
-        console.log(f"[yellow]Skipped as the {exporter_name} image is already present")
+    # Only rebuild the image if its sources changed since it was built
+    version = build_context_version(exporter_dir)
+    if image_version(exporter_name) == version:
+        console.log(f"[yellow]Skipped as the {exporter_name} image is up to date")
     else:
-        build_image(f"{exporter_name}", exporter_dir, verbose=verbose)
+        build_image(exporter_name, exporter_dir, verbose=verbose, version=version)
         console.log(f"[green]The {exporter_name} image was built successfully")
 
     # Run the container
@@ -289,18 +598,12 @@ def prepare_exporter(server, verbose=False, supportconfig_path=None):
 
     if not supportconfig_path:
         # Get the Salt UID/GID
-        id_process = ssh_call(server, ["id", "salt"])
-        if id_process.returncode != 0:
-            err = id_process.stderr.read()
-            if "no such user" in err:
-                raise HealthException(
-                    "Salt is not installed... is the tool running on an Uyuni server?"
-                )
-            else:
-                raise HealthException(f"Failed to get Salt GID on server: {err}")
-        id_out = id_process.stdout.read()
-        salt_uid = re.match(".*uid=([0-9]+)", id_out).group(1)
-        salt_gid = re.match(".*gid=([0-9]+)", id_out).group(1)
+        salt_ids = get_user_ids("salt", server)
+        if not salt_ids:
+            raise HealthException(
+                "Salt is not installed... is the tool running on an Uyuni server?"
+            )
+        salt_uid, salt_gid = salt_ids
 
     # Prepare arguments for Podman call
     podman_args = [
@@ -323,6 +626,8 @@ def prepare_exporter(server, verbose=False, supportconfig_path=None):
             [
                 "-u",
                 f"{salt_uid}:{salt_gid}",
+                # The Salt job IDs are in the server local time
+                "--tz=local",
                 "-v",
                 "/etc/salt:/etc/salt:ro",
                 "-v",
@@ -353,13 +658,11 @@ def prepare_grafana(server, verbose=False):
         )
     else:
         # Copy the grafana config
-        grafana_cfg = os.path.join(os.path.dirname(__file__), "grafana")
+        grafana_cfg = GRAFANA_CFG
 
         if server:
             try:
-                subprocess.run(
-                    ["scp", "-rq", grafana_cfg, f"{server}:/tmp/"], check=True
-                )
+                scp(server, [grafana_cfg], recursive=True)
                 grafana_cfg = "/tmp/grafana"
             except Exception:
                 raise HealthException(
@@ -402,15 +705,11 @@ def prepare_prometheus(server, verbose=False):
         )
     else:
         # Copy the prometheus config
-        prometheus_cfg = os.path.join(
-            os.path.dirname(__file__), "prometheus", "prometheus.yml"
-        )
+        prometheus_cfg = PROMETHEUS_CFG
 
         if server:
             try:
-                subprocess.run(
-                    ["scp", "-rq", prometheus_cfg, f"{server}:/tmp/"], check=True
-                )
+                scp(server, [prometheus_cfg], recursive=True)
                 prometheus_cfg = "/tmp/prometheus.yml"
             except Exception:
                 raise HealthException(
@@ -473,22 +772,30 @@ def run_loki(server, supportconfig_path=None, verbose=False):
     """
     if container_is_running("loki", server=server):
         console.log("[yellow]Skipped as the loki container is already running")
-    else:
-        loki_cfg = os.path.join(os.path.dirname(__file__), "loki/config.yaml")
+        return
+
+    # Get the promtail image ready while loki is starting
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        promtail_image = executor.submit(
+            run_step,
+            "Building promtail image",
+            prepare_promtail_image,
+            server,
+            verbose=verbose,
+        )
+
+        loki_cfg = LOKI_CFG
         promtail_cfg = render_promtail_cfg(supportconfig_path)
 
         # Copy the promtail and loki config files if necessary
         if server:
             try:
-                subprocess.run(
-                    ["scp", "-q", promtail_cfg, f"{server}:/tmp/"], check=True
-                )
+                scp(server, [promtail_cfg, loki_cfg])
                 promtail_cfg = "/tmp/promtail.yaml"
-                subprocess.run(["scp", "-q", loki_cfg, f"{server}:/tmp/"], check=True)
-                promtail_cfg = "/tmp/loki.yaml"
+                loki_cfg = "/tmp/config.yaml"
             except Exception:
                 raise HealthException(
-                    f"Failed to copy promtail configuration to {server}"
+                    f"Failed to copy promtail and loki configuration to {server}"
                 )
 
         # Run loki container
@@ -510,43 +817,57 @@ def run_loki(server, supportconfig_path=None, verbose=False):
         )
 
         # Run promtail only now since it pushes data to loki
-        console.log("[bold]Building promtail image")
-        build_loki_image("promtail", verbose=verbose)
-        if server:
-            transfer_image(server, "promtail")
-
-        podman_args = [
-            "run",
-            "--replace",
-            "-d",
-            "-v",
-            f"{promtail_cfg}:/etc/promtail/config.yml",
-            "-v",
-            "/var/log/:/var/log/",
-        ]
+        promtail_image.result()
 
-        if supportconfig_path:
-            podman_args.extend(
-                [
-                    "-v",
-                    f"{supportconfig_path}:{supportconfig_path}",
-                ]
-            )
+    podman_args = [
+        "run",
+        "--replace",
+        "-d",
+        "-v",
+        f"{promtail_cfg}:/etc/promtail/config.yml",
+        "-v",
+        "/var/log/:/var/log/",
+    ]
 
+    if supportconfig_path:
         podman_args.extend(
             [
-                "--name",
-                "promtail",
-                "--pod",
-                "uyuni-health-check",
-                "promtail",
+                "-v",
+                f"{supportconfig_path}:{supportconfig_path}",
             ]
         )
-        podman(
-            podman_args,
-            server,
-            console=console,
-        )
+
+    podman_args.extend(
+        [
+            "--name",
+            "promtail",
+            "--pod",
+            "uyuni-health-check",
+            "promtail",
+        ]
+    )
+    podman(
+        podman_args,
+        server,
+        console=console,
+    )
+
+
+def prepare_promtail_image(server, verbose=False):
+    """
+    Build the promtail image and copy it to the server if needed
+    """
+    build_loki_image("promtail", verbose=verbose)
+    if server:
+        transfer_image(server, "promtail")
+
+
+def run_step(title, func, *args, **kwargs):
+    """
+    Log the title of a step and run it
+    """
+    console.log(f"[bold]{title}")
+    return func(*args, **kwargs)
 
 
 def clean_server(server):
@@ -588,6 +909,7 @@ def clean_server(server):
                     server,
                     console=console,
                 )
+                _existing_images.discard(_image_key(server, image))
                 console.log(f"[green]{image} image has been removed")
 
 
@@ -626,6 +948,9 @@ def cli(ctx, server, supportconfig_path, verbose):
         console.print(Markdown("# Execution Finished"))
         exit(1)
 
+    if server:
+        ctx.call_on_close(lambda: ssh_close(server))
+
     try:
         console.log("[bold]Checking connection with podman:")
         ssh_call(server, ["podman", "--version"], console=console, quiet=False)
@@ -733,8 +1058,14 @@ def start(ctx):
     is_flag=True,
     help="Remove containers after execution",
 )
+@click.option(
+    "--metrics-cache-ttl",
+    default=10,
+    type=int,
+    help="Reuse the exporter metrics fetched less than X seconds ago, 0 to disable. (Default: 10)",
+)
 @click.pass_context
-def run(ctx, exporter_port, loki, logs, since, clean):
+def run(ctx, exporter_port, loki, logs, since, clean, metrics_cache_ttl):
     """
     Start execution of Uyuni Health Check
 
@@ -743,6 +1074,7 @@ def run(ctx, exporter_port, loki, logs, since, clean):
     :param server: the server to connect to
     :param exporter_port: uyuni health exporter metrics port
     :param loki: URL to a loki instance. Setting it will skip the promtail and loki deployments
+    :param metrics_cache_ttl: seconds during which the fetched exporter metrics are reused
     """
     server = ctx.obj["server"]
     verbose = ctx.obj["verbose"]
@@ -753,45 +1085,66 @@ def run(ctx, exporter_port, loki, logs, since, clean):
             console.log("[bold]Creating POD for containers")
             create_pod(server)
 
-            console.log("[bold]Building logcli image")
-            build_loki_image("logcli", server=server, verbose=verbose)
-
-            console.log("[bold]Deploying promtail and Loki")
-            if not loki:
-                run_loki(server, supportconfig_path=supportconfig_path, verbose=verbose)
-            else:
-                console.log(f"[yellow]Skipped to use Loki at {loki}")
-
-            console.log("[bold]Preparing prometheus exporter")
-            prepare_exporter(
-                server, supportconfig_path=supportconfig_path, verbose=verbose
-            )
-
-            console.log("[bold]Preparing grafana")
-            prepare_grafana(server, verbose=verbose)
-
-            console.log("[bold]Preparing prometheus")
-            prepare_prometheus(server, verbose=verbose)
+            # These steps only depend on the pod: run them side by side
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [
+                    executor.submit(
+                        run_step,
+                        "Preparing prometheus exporter",
+                        prepare_exporter,
+                        server,
+                        supportconfig_path=supportconfig_path,
+                        verbose=verbose,
+                    ),
+                    executor.submit(
+                        run_step,
+                        "Preparing grafana",
+                        prepare_grafana,
+                        server,
+                        verbose=verbose,
+                    ),
+                    executor.submit(
+                        run_step,
+                        "Preparing prometheus",
+                        prepare_prometheus,
+                        server,
+                        verbose=verbose,
+                    ),
+                ]
+                if not supportconfig_path:
+                    # The services check doesn't even need the pod
+                    futures.append(
+                        executor.submit(
+                            run_step,
+                            "Checking spacewalk and postgresql services",
+                            check_spacewalk_services,
+                            server,
+                            verbose=verbose,
+                        )
+                    )
+
+                console.log("[bold]Deploying promtail and Loki")
+                if not loki:
+                    run_loki(
+                        server, supportconfig_path=supportconfig_path, verbose=verbose
+                    )
+                else:
+                    console.log(f"[yellow]Skipped to use Loki at {loki}")
+
+                for future in as_completed(futures):
+                    future.result()
 
             if not supportconfig_path:
                 # Fetch metrics from uyuni-health-exporter
                 console.log("[bold]Fetching metrics from uyuni-health-exporter")
                 metrics = fetch_metrics_from_uyuni_health_exporter(
-                    console, server, exporter_port
+                    console, server, exporter_port, cache_ttl=metrics_cache_ttl
                 )
-
-                # Check spacewalk services
-                console.log("[bold]Checking spacewalk services")
-                check_spacewalk_services(server, verbose=verbose)
-
-                # Check spacewalk services
-                console.log("[bold]Checking postgresql service")
-                check_postgres_service(server)
             else:
                 # Fetch metrics from supportconfig-exporter
                 console.log("[bold]Fetching metrics from supportconfig-exporter")
                 metrics = fetch_metrics_from_supportconfig_exporter(
-                    console, server, exporter_port
+                    console, server, exporter_port, cache_ttl=metrics_cache_ttl
                 )
 
             console.log(
@@ -2,11 +2,13 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
-import json
+import os
 import re
 import time
-from datetime import datetime, timedelta
-from json.decoder import JSONDecodeError
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from operator import itemgetter
 
 import requests
 from rich import print
@@ -17,56 +19,89 @@ from rich.panel import Panel
 from rich.table import Table
 from rich.text import Text
 
-from uyuni_health_check.util import HealthException, podman
+from uyuni_health_check.util import (
+    CACHE_DIR,
+    HTTP_TIMEOUT,
+    HealthException,
+    http_session,
+)
+
+# Seconds to wait for the exporter to send its metrics once connected
+METRICS_TIMEOUT = 10
+
+# Seconds to wait for Loki to answer a query once connected
+LOKI_QUERY_TIMEOUT = 30
+
+# LogQL selection of the log lines reporting errors
+ERROR_LOGS_QUERY = '{job=~".+"} |~ `(?i)error|(?i)severe|(?i)critical|(?i)fatal`'
+
+# Label name and value pairs of a sample in the Prometheus text format
+LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+@contextmanager
+def _buffered(console: "Console"):
+    """
+    Write everything printed on the console in the block at once
+    """
+    with console.capture() as capture:
+        yield
+    console.file.write(capture.get())
+    console.file.flush()
 
 
 def show_uyuni_live_server_metrics(metrics: dict, console: "Console"):
     """
     Gather the data from the exporter and loki and display them
     """
-    console.print(Markdown("## Uyuni server and Salt Master stats"))
-    console.print()
-    if metrics:
-        tables = []
-        tables.append(show_salt_jobs_summary(metrics))
-        tables.append(show_salt_master_stats(metrics))
-        tables.append(show_uyuni_summary(metrics))
-        console.print(Columns(tables), justify="center")
-    else:
-        console.print(
-            "[yellow]Some metrics are still missing. Wait some seconds and execute again",
-            justify="center",
-        )
+    with _buffered(console):
+        console.print(Markdown("## Uyuni server and Salt Master stats"))
+        console.print()
+        if metrics:
+            tables = []
+            tables.append(show_salt_jobs_summary(metrics))
+            tables.append(show_salt_master_stats(metrics))
+            tables.append(show_uyuni_summary(metrics))
+            console.print(Columns(tables), justify="center")
+        else:
+            console.print(
+                "[yellow]Some metrics are still missing. Wait some seconds and execute again",
+                justify="center",
+            )
 
 
 def show_supportconfig_metrics(metrics: dict, console: "Console"):
-    if metrics:
-        tables = []
-        tables.append(show_salt_jobs_summary(metrics))
-        tables.append(show_salt_keys_summary(metrics))
-        tables.append(show_salt_master_configuration_summary(metrics))
-        console.print(Columns(tables), justify="center")
-    else:
-        console.print(
-            "[yellow]Some metrics are still missing. Wait some seconds and execute again",
-            justify="center",
-        )
+    with _buffered(console):
+        if metrics:
+            tables = []
+            tables.append(show_salt_jobs_summary(metrics))
+            tables.append(show_salt_keys_summary(metrics))
+            tables.append(show_salt_master_configuration_summary(metrics))
+            console.print(Columns(tables), justify="center")
+        else:
+            console.print(
+                "[yellow]Some metrics are still missing. Wait some seconds and execute again",
+                justify="center",
+            )
 
 
 def show_relevant_hints(hints, console: "Console"):
-    console.print(Markdown("## Relevant hints. Please take a look!"))
-    console.print()
-
-    if not hints:
-        console.print(
-            Panel(Text("Good news! There are no relevant hints.", justify="center")),
-            style="italic green",
-        )
-    else:
-        for hint in hints:
-            console.print(hint, justify="center")
+    with _buffered(console):
+        console.print(Markdown("## Relevant hints. Please take a look!"))
+        console.print()
+
+        if not hints:
+            console.print(
+                Panel(
+                    Text("Good news! There are no relevant hints.", justify="center")
+                ),
+                style="italic green",
+            )
+        else:
+            for hint in hints:
+                console.print(hint, justify="center")
 
-    console.print()
+        console.print()
 
 
 def show_error_logs_stats(loki, since, console: "Console"):
@@ -75,32 +110,11 @@ def show_error_logs_stats(loki, since, console: "Console"):
     """
     print(Markdown(f"- Errors in logs over the last {since} days:"))
     print()
-    loki_url = loki or "http://loki:3100"
-    process = podman(
-        [
-            "run",
-            "-ti",
-            "--rm",
-            "--pod",
-            "uyuni-health-check",
-            "--name",
-            "logcli",
-            "logcli",
-            "--quiet",
-            f"--addr={loki_url}",
-            "instant-query",
-            "--limit",
-            "150",
-            'count_over_time({job=~".+"} |~ `(?i)error|(?i)severe|(?i)critical|(?i)fatal` ['
-            + str(since)
-            + "d])",
-        ]
+    data = query_loki(
+        loki,
+        "query",
+        {"query": f"count_over_time({ERROR_LOGS_QUERY} [{since}d])", "limit": 150},
     )
-    response = process.stdout.read()
-    try:
-        data = json.loads(response)
-    except JSONDecodeError:
-        raise HealthException(f"Invalid logcli response: {response}")
 
     if data:
         table = Table(show_header=True, header_style="bold magenta")
@@ -129,39 +143,60 @@ def show_full_error_logs(loki, since, console: "Console"):
     """
     print()
     print(Markdown(f"- Error logs of the last {since} days:"))
-    from_time = (datetime.utcnow() - timedelta(days=since)).isoformat()
-    loki_url = loki or "http://loki:3100"
-    podman(
-        [
-            "run",
-            "-ti",
-            "--rm",
-            "--pod",
-            "uyuni-health-check",
-            "--name",
-            "logcli",
-            "logcli",
-            "--quiet",
-            f"--addr={loki_url}",
-            "query",
-            f"--from={from_time}Z",
-            "--limit=150",
-            '{job=~".+"} |~ `(?i)error|(?i)severe|(?i)critical|(?i)fatal`',
-        ],
-        console=console,
+    # Loki wants nanoseconds since the epoch
+    start = int((time.time() - since * 24 * 3600) * 10**9)
+    streams = query_loki(
+        loki,
+        "query_range",
+        {"query": ERROR_LOGS_QUERY, "start": start, "limit": 150},
     )
+    entries = [
+        (int(timestamp), stream["stream"].get("filename", ""), line)
+        for stream in streams
+        for timestamp, line in stream["values"]
+    ]
+    # Merge the streams, newest first like Loki returns them
+    for timestamp, filename, line in sorted(entries, reverse=True):
+        logged_at = datetime.fromtimestamp(timestamp / 10**9).isoformat(
+            timespec="seconds"
+        )
+        console.print(Text(f"{logged_at} {filename} {line}"))
     print()
 
 
+def query_loki(loki, endpoint, params):
+    """
+    Run a query using the Loki HTTP API
+
+    :param loki: the URL of the Loki instance
+    :param endpoint: the query API to call, like query or query_range
+    :return: the result of the query
+    """
+    loki_url = loki or "http://localhost:3100"
+    with http_session() as session:
+        try:
+            response = session.get(
+                f"{loki_url}/loki/api/v1/{endpoint}",
+                params=params,
+                timeout=(HTTP_TIMEOUT, LOKI_QUERY_TIMEOUT),
+            )
+            response.raise_for_status()
+            return response.json()["data"]["result"]
+        except requests.exceptions.RequestException as err:
+            raise HealthException(f"Failed to query Loki: {err}")
+        except (ValueError, KeyError):
+            raise HealthException(f"Invalid Loki response: {response.text}")
+
+
 def show_salt_jobs_summary(metrics: dict):
     table = Table(show_header=True, header_style="bold magenta")
     table.add_column("Salt function name")
     table.add_column("Total")
 
     for metric, value in sorted(
-        metrics["salt_jobs"].items(), reverse=True, key=lambda item: item[1]
+        metrics["salt_jobs"].items(), reverse=True, key=itemgetter(1)
     ):
-        table.add_row(metric, str(int(value)))
+        table.add_row(metric, str(value))
 
     return table
 
@@ -172,9 +207,9 @@ def show_salt_keys_summary(metrics: dict):
     table.add_column("Total")
 
     for metric, value in sorted(
-        metrics["salt_keys"].items(), reverse=True, key=lambda item: item[1]
+        metrics["salt_keys"].items(), reverse=True, key=itemgetter(1)
     ):
-        table.add_row(metric, str(int(value)))
+        table.add_row(metric, str(value))
 
     return table
 
@@ -185,9 +220,9 @@ def show_salt_master_configuration_summary(metrics: dict):
     table.add_column("Value")
 
     for metric, value in sorted(
-        metrics["salt_master_config"].items(), reverse=True, key=lambda item: item[1]
+        metrics["salt_master_config"].items(), reverse=True, key=itemgetter(1)
     ):
-        table.add_row(metric, str(int(value)))
+        table.add_row(metric, str(value))
 
     return table
 
@@ -198,9 +233,9 @@ def show_salt_master_stats(metrics: dict):
     table.add_column("Total")
 
     for metric, value in sorted(
-        metrics["salt_master_stats"].items(), key=lambda item: item[0]
+        metrics["salt_master_stats"].items(), key=itemgetter(0)
     ):
-        table.add_row(metric, str(int(value)))
+        table.add_row(metric, str(value))
 
     return table
 
@@ -210,109 +245,164 @@ def show_uyuni_summary(metrics: dict):
     table.add_column("Name")
     table.add_column("Total")
 
-    for metric, value in sorted(
-        metrics["uyuni_summary"].items(), key=lambda item: item[0]
-    ):
-        table.add_row(metric, str(int(value)))
+    for metric, value in sorted(metrics["uyuni_summary"].items(), key=itemgetter(0)):
+        table.add_row(metric, str(value))
 
     return table
 
 
+def parse_exposition(metrics_raw: str, names: list) -> dict:
+    """
+    Get the samples of some metrics in a single pass over a Prometheus exposition
+
+    :param names: the names of the metrics to get
+    :return: a list of (labels dict, value) tuples for each of the metric names
+    """
+    samples = {name: [] for name in names}
+    for line in metrics_raw.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, brace, rest = line.partition("{")
+        if not brace or name not in samples:
+            continue
+        labels, _, value = rest.rpartition("} ")
+        samples[name].append((dict(LABEL_RE.findall(labels)), float(value.split()[0])))
+    return samples
+
+
 def _fetch_metrics_from_exporter(
-    console: "Console", host="localhost", port=9000, max_retries=5
+    console: "Console",
+    exporter,
+    names,
+    host="localhost",
+    port=9000,
+    max_retries=5,
+    cache_ttl=0,
 ):
-    for i in range(max_retries):
+    """
+    Get the samples of some metrics from an exporter
+
+    :param exporter: the kind of exporter, part of the cache key since the
+        exporters share the same port
+    :param names: the names of the metrics to get
+    :param cache_ttl: seconds during which the previously fetched metrics are reused
+    :return: a list of (labels dict, value) tuples for each of the metric names
+    """
+    cache_path = os.path.join(CACHE_DIR, f"metrics-{exporter}-{host}-{port}.txt")
+    if cache_ttl > 0:
         try:
-            metrics_raw = requests.get(f"http://{host}:{port}").content.decode()
-            return metrics_raw
-        except requests.exceptions.RequestException as exc:
-            if i < max_retries - 1:
-                time.sleep(1)
-                console.log("[italic]retrying...")
-            else:
-                console.log(
-                    "[italic red]There was an error while fetching metrics from exporter[/italic red]"
+            if time.time() - os.path.getmtime(cache_path) < cache_ttl:
+                with open(cache_path) as cache:
+                    console.log("[italic]using recently fetched metrics")
+                    return parse_exposition(cache.read(), names)
+        except OSError:
+            pass
+
+    # Keep the connection alive between the retries
+    with http_session() as session:
+        for i in range(max_retries):
+            try:
+                response = session.get(
+                    f"http://{host}:{port}", timeout=(HTTP_TIMEOUT, METRICS_TIMEOUT)
                 )
-                print(f"{exc}")
-                exit(1)
+                response.raise_for_status()
+                metrics_raw = response.content.decode()
+                samples = parse_exposition(metrics_raw, names)
+                # An exporter still starting up may not have all the metrics yet
+                if cache_ttl > 0 and all(samples.values()):
+                    _write_metrics_cache(cache_path, metrics_raw)
+                return samples
+            except requests.exceptions.RequestException as exc:
+                if i < max_retries - 1:
+                    time.sleep(1)
+                    console.log("[italic]retrying...")
+                else:
+                    console.log(
+                        "[italic red]There was an error while fetching metrics from exporter[/italic red]"
+                    )
+                    print(f"{exc}")
+                    exit(1)
+
+
+def _write_metrics_cache(path, metrics_raw):
+    # Write to a temporary file first to never read a partial cache
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.part", "w") as cache:
+            cache.write(metrics_raw)
+        os.replace(f"{path}.part", path)
+    except OSError:
+        pass
 
 
 def fetch_metrics_from_supportconfig_exporter(
-    console: "Console", host="localhost", port=9000, max_retries=5
+    console: "Console", host="localhost", port=9000, max_retries=5, cache_ttl=0
 ):
     if not host:
         host = "localhost"
 
-    metrics_raw = _fetch_metrics_from_exporter(console, host, port, max_retries)
-
-    salt_jobs = re.findall(r'salt_jobs{fun="(.+)",jid="(.+)"} (.+)', metrics_raw)
-    salt_keys = re.findall(r'salt_keys{name="(.+)"} (.+)', metrics_raw)
-    salt_master_config = re.findall(
-        r'salt_master_config{name="(.+)"} (.+)', metrics_raw
+    samples = _fetch_metrics_from_exporter(
+        console,
+        "supportconfig",
+        ["salt_jobs", "salt_keys", "salt_master_config"],
+        host,
+        port,
+        max_retries,
+        cache_ttl,
     )
-
-    if not salt_jobs or not salt_keys or not salt_master_config:
+    if not all(samples.values()):
         console.log(
             "[yellow]Some metrics are still missing. Wait some seconds and execute again"
         )
         return {}
 
     metrics = {
-        "salt_jobs": {},
-        "salt_keys": {},
-        "salt_master_config": {},
+        "salt_jobs": dict(Counter(labels["fun"] for labels, _ in samples["salt_jobs"])),
+        "salt_keys": {
+            labels["name"]: int(value) for labels, value in samples["salt_keys"]
+        },
+        "salt_master_config": {
+            labels["name"]: int(value)
+            for labels, value in samples["salt_master_config"]
+        },
     }
 
-    for m in salt_jobs:
-        if m[0] in metrics["salt_jobs"]:
-            metrics["salt_jobs"][m[0]] += 1
-        else:
-            metrics["salt_jobs"][m[0]] = 1
-
-    for m in salt_master_config:
-        metrics["salt_master_config"][m[0]] = float(m[1])
-
-    for m in salt_keys:
-        metrics["salt_keys"][m[0]] = float(m[1])
-
     console.log("[green]metrics have been successfully collected")
     return metrics
 
 
 def fetch_metrics_from_uyuni_health_exporter(
-    console: "Console", host="localhost", port=9000, max_retries=5
+    console: "Console", host="localhost", port=9000, max_retries=5, cache_ttl=0
 ):
     if not host:
         host = "localhost"
 
-    metrics_raw = _fetch_metrics_from_exporter(console, host, port, max_retries)
-
-    salt_metrics = re.findall(r'salt_jobs{fun="(.+)",name="(.+)"} (.+)', metrics_raw)
-    uyuni_metrics = re.findall(r'uyuni_summary{name="(.+)"} (.+)', metrics_raw)
-    salt_master_metrics = re.findall(
-        r'salt_master_stats{name="(.+)"} (.+)', metrics_raw
+    samples = _fetch_metrics_from_exporter(
+        console,
+        "uyuni",
+        ["salt_jobs", "salt_master_stats", "uyuni_summary"],
+        host,
+        port,
+        max_retries,
+        cache_ttl,
     )
-
-    if not salt_metrics or not uyuni_metrics or not salt_master_metrics:
+    if not all(samples.values()):
         console.log(
             "[yellow]Some metrics are still missing. Wait some seconds and execute again"
         )
         return {}
 
     metrics = {
-        "salt_jobs": {},
-        "salt_master_stats": {},
-        "uyuni_summary": {},
+        "salt_jobs": {
+            labels["fun"]: int(value) for labels, value in samples["salt_jobs"]
+        },
+        "salt_master_stats": {
+            labels["name"]: int(value) for labels, value in samples["salt_master_stats"]
+        },
+        "uyuni_summary": {
+            labels["name"]: int(value) for labels, value in samples["uyuni_summary"]
+        },
     }
 
-    for m in salt_metrics:
-        metrics["salt_jobs"][m[0]] = float(m[2])
-
-    for m in salt_master_metrics:
-        metrics["salt_master_stats"][m[0]] = float(m[1])
-
-    for m in uyuni_metrics:
-        metrics["uyuni_summary"][m[0]] = float(m[1])
-
     console.log("[green]metrics have been successfully collected")
     return metrics
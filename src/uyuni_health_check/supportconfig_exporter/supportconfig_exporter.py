@@ -20,6 +20,36 @@ def sigterm_handler(**kwargs):
 
 signal.signal(signal.SIGTERM, sigterm_handler)
 
+# Command title and output blocks of the supportconfig files
+SECTION_RE = re.compile(r"^#==\[ ([^\]\n]*) \]=+#$((?:\n.+)+)$", re.MULTILINE)
+
+# Salt master settings to expose
+SALT_CONFIG_ATTRS = [
+    "worker_threads",
+    "sock_pool_size",
+    "timeout",
+    "gather_job_timeout",
+]
+
+# Any of the exposed settings, to find them all in a single pass
+SALT_CONFIG_RE = re.compile(
+    f"^({'|'.join(SALT_CONFIG_ATTRS)}): ([0-9]+)$", re.MULTILINE
+)
+
+# Lists of keys of each state in the salt-key output.
+# The lazy repetitions stop at the next title instead of going to the end of
+# the file and backtracking.
+SALT_KEYS_RE = re.compile(
+    r"^Accepted Keys:$((?:\n.*)*?)\nDenied Keys:$((?:\n.*)*?)\n"
+    r"Unaccepted Keys:$((?:\n.*)*?)\nRejected Keys:$((?:\n.*)*?)#==",
+    re.MULTILINE,
+)
+
+# ID and function of each job in the salt-run jobs.list_jobs output
+SALT_JOBS_RE = re.compile(
+    "^'([0-9]+)':$(?:\n.*\n.*Function: (.*)\n[^'|#==]*)", re.MULTILINE
+)
+
 
 class SupportConfigMetricsCollector(object):
     def __init__(self, supportconfig_path=None):
@@ -43,7 +73,7 @@ class SupportConfigMetricsCollector(object):
         content = None
         with open(os.path.join(self.supportconfig_path, filein)) as f:
             content = f.read()
-        parsed = re.findall(r"^#==\[ (.*) \]=+#$((?:\n.+)+)$", content, re.MULTILINE)
+        parsed = SECTION_RE.findall(content)
         ret = {}
         for _, value in parsed:
             cmd, val = self._parse_command(value)
@@ -54,7 +84,7 @@ class SupportConfigMetricsCollector(object):
         content = None
         with open(os.path.join(self.supportconfig_path, filein)) as f:
             content = f.read()
-        parsed = re.findall(r"^#==\[ (.*) \]=+#$((?:\n.+)+)$", content, re.MULTILINE)
+        parsed = SECTION_RE.findall(content)
         ret = {}
         for _, value in parsed:
             cmd, val = self._parse_command(value)
@@ -67,16 +97,9 @@ class SupportConfigMetricsCollector(object):
             os.path.join(self.supportconfig_path, "plugin-saltconfiguration.txt")
         ) as f:
             content = f.read()
-        attrs_to_expose = [
-            "worker_threads",
-            "sock_pool_size",
-            "timeout",
-            "gather_job_timeout",
-        ]
-        ret = {}
-        for attr in attrs_to_expose:
-            ret[attr] = re.findall(f"^{attr}: ([0-9]+)$", content, re.MULTILINE)[-1]
-        return ret
+        # The last occurrence of a setting wins, like in the salt configuration
+        values = dict(SALT_CONFIG_RE.findall(content))
+        return {attr: values[attr] for attr in SALT_CONFIG_ATTRS}
 
     def read_salt_keys(self):
         content = None
@@ -85,12 +108,7 @@ class SupportConfigMetricsCollector(object):
         ) as f:
             content = f.read()
         ret = {}
-        parsed = re.findall(
-            r"^Accepted Keys:$((?:\n.*)*)\nDenied Keys:$((?:\n.*)*)\n"
-            r"Unaccepted Keys:$((?:\n.*)*)\nRejected Keys:$((?:\n.*)*)#==",
-            content,
-            re.MULTILINE,
-        )[0]
+        parsed = SALT_KEYS_RE.findall(content)[0]
         ret["accepted"] = parsed[0].strip().split("\n") if parsed[0].strip() else []
         ret["denied"] = parsed[1].strip().split("\n") if parsed[1].strip() else []
         ret["unaccepted"] = parsed[2].strip().split("\n") if parsed[2].strip() else []
@@ -101,9 +119,7 @@ class SupportConfigMetricsCollector(object):
         content = None
         with open(os.path.join(self.supportconfig_path, "plugin-saltjobs.txt")) as f:
             content = f.read()
-        return re.findall(
-            "^'([0-9]+)':$(?:\n.*\n.*Function: (.*)\n[^'|#==]*)", content, re.MULTILINE
-        )
+        return SALT_JOBS_RE.findall(content)
 
     def collect(self):
         gauge = GaugeMetricFamily(
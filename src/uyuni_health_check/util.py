@@ -2,11 +2,49 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import functools
 import os
+import shlex
 import subprocess
+import threading
 
+import requests
 from jinja2 import Environment, FileSystemLoader
+from requests.adapters import HTTPAdapter
 from rich.text import Text
+from urllib3.util.retry import Retry
+
+# Folder of the package data: image build contexts and configuration files
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Where to keep the downloaded files between runs
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "uyuni-health-check",
+)
+
+# Seconds to wait for an HTTP server to answer
+HTTP_TIMEOUT = 2
+
+# Share a single SSH connection between all the ssh and scp calls to a server.
+# The socket lives in the user's .ssh folder so that other local users can't
+# squat its path, %C hashes the local host, remote host, port and user.
+# Never prompt for a password: fail right away if the key is refused, and
+# detect connections dropped by the network within 45 seconds.
+SSH_OPTIONS = [
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "ServerAliveInterval=15",
+    "-o",
+    "ServerAliveCountMax=3",
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    "ControlPersist=60s",
+    "-o",
+    "ControlPath=~/.ssh/uyuni-hc-%C",
+]
 
 
 class HealthException(Exception):
@@ -14,7 +52,7 @@ class HealthException(Exception):
         super().__init__(message)
 
 
-def ssh_call(server, cmd, console=None, quiet=True):
+def ssh_call(server, cmd, console=None, quiet=True, timeout=None):
     """
     Run a command over SSH.
 
@@ -22,64 +60,199 @@ def ssh_call(server, cmd, console=None, quiet=True):
 
     For now the function assumes passwordless connection to the server on default SSH port.
     Use SSH agent and config to adjust if needed.
+
+    :param timeout: seconds after which the command is killed, `None` to wait forever
+    :return: the `subprocess.CompletedProcess` of the finished command, without
+        output when it was logged to the console
     """
+    # The remote shell would split and expand the arguments again
     if server and quiet:
-        ssh_cmd = ["ssh", "-q", server] + cmd
+        ssh_cmd = ["ssh", "-q"] + SSH_OPTIONS + [server]
+        ssh_cmd += [shlex.quote(arg) for arg in cmd]
     elif server:
-        ssh_cmd = ["ssh", server] + cmd
+        ssh_cmd = ["ssh"] + SSH_OPTIONS + [server]
+        ssh_cmd += [shlex.quote(arg) for arg in cmd]
     else:
         ssh_cmd = cmd
-    process = subprocess.Popen(
-        ssh_cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        stdin=subprocess.DEVNULL,
-        universal_newlines=True,
-    )
 
-    if console and not quiet:
-        while True:
-            line = process.stdout.readline() or process.stderr.readline()
-            if not line:
-                break
-            console.log(Text.from_ansi(line.strip()))
+    try:
+        if console and not quiet:
+            process = _run_logged(ssh_cmd, console, timeout)
+        else:
+            process = subprocess.run(
+                ssh_cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                stdin=subprocess.DEVNULL,
+                universal_newlines=True,
+                timeout=timeout,
+            )
+    except subprocess.TimeoutExpired:
+        raise HealthException(f"Timed out after {timeout}s running: {cmd}")
 
-    returncode = process.wait()
-    if returncode == 127:
+    if process.returncode == 127:
         raise OSError(f"Command not found: {cmd[0]}")
-    elif returncode == 125:
+    elif process.returncode == 125:
         raise HealthException(
             "An error had happened while running Podman. Maybe you don't have enough privileges to run it."
         )
-    elif returncode == 255:
+    elif process.returncode == 255 and server:
+        raise HealthException(
+            f"SSH connection to {server} failed, check the authentication and that it is reachable. Running: {cmd}"
+        )
+    elif process.returncode == 255:
         raise HealthException(f"There has been an error running: {cmd}")
     return process
 
 
-def podman(cmd, server=None, console=None):
+def _run_logged(cmd, console, timeout=None):
+    """
+    Run a command, logging its merged stdout and stderr lines as they come
+
+    The lines are not kept to run in constant memory even on huge outputs.
+    """
+    timed_out = threading.Event()
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        stdin=subprocess.DEVNULL,
+        universal_newlines=True,
+    ) as process:
+
+        def kill():
+            timed_out.set()
+            process.kill()
+
+        # Reading the output blocks, so the process is killed from a timer instead
+        killer = threading.Timer(timeout, kill) if timeout else None
+        if killer:
+            killer.start()
+        try:
+            for line in process.stdout:
+                console.log(Text.from_ansi(line.strip()))
+            process.wait()
+        finally:
+            if killer:
+                killer.cancel()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    return subprocess.CompletedProcess(cmd, process.returncode)
+
+
+def scp(server, sources, dest="/tmp/", recursive=False):
+    """
+    Copy local files to the server over the shared SSH connection
+
+    :param sources: list of the local paths to copy
+    :param dest: the destination path on the server
+    """
+    flags = "-rq" if recursive else "-q"
+    subprocess.run(
+        ["scp", flags] + SSH_OPTIONS + sources + [f"{server}:{dest}"], check=True
+    )
+
+
+def pipe_to_server(cmd, server, remote_cmd, timeout=None):
+    """
+    Stream the output of a local command to the input of a command on the server
+
+    :param cmd: the local command in an array format
+    :param remote_cmd: the command to run on the server in an array format
+    :param timeout: seconds after which the commands are killed, `None` to wait forever
+    :return: whether both commands succeeded
+    """
+    ssh_cmd = ["ssh", "-q"] + SSH_OPTIONS + [server]
+    ssh_cmd += [shlex.quote(arg) for arg in remote_cmd]
+    with subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL
+    ) as local, subprocess.Popen(
+        ssh_cmd, stdin=local.stdout, stdout=subprocess.DEVNULL
+    ) as remote:
+        # Only the remote command reads the pipe now: if it dies,
+        # the local command gets a SIGPIPE instead of blocking forever
+        local.stdout.close()
+        try:
+            remote.wait(timeout=timeout)
+            local.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            local.kill()
+            remote.kill()
+            raise HealthException(f"Timed out after {timeout}s running: {cmd}")
+    return local.returncode == 0 and remote.returncode == 0
+
+
+def ssh_close(server):
+    """
+    Stop the shared SSH connection to the server if any
+    """
+    subprocess.run(
+        ["ssh"] + SSH_OPTIONS + ["-O", "exit", server],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def http_session():
+    """
+    Create an HTTP session keeping its connections alive between requests
+
+    Failed connections are retried a few times, but not error statuses since
+    those are valid answers to our readiness probes.
+    """
+    session = requests.Session()
+    retries = Retry(connect=2, read=0, status=0, backoff_factor=0.1)
+    session.mount("http://", HTTPAdapter(max_retries=retries))
+    return session
+
+
+def http_get(session, url, timeout=HTTP_TIMEOUT):
+    """
+    GET an URL and return the response or `None` if the server couldn't be reached
+    """
+    try:
+        return session.get(url, timeout=timeout)
+    except requests.exceptions.RequestException:
+        return None
+
+
+def podman(cmd, server=None, console=None, timeout=None):
     """
     Run a podman command
 
     :param cmd: the command in an array format without the initial "podman" part
+    :param timeout: seconds after which the command is killed, `None` to wait forever
     """
     try:
-        return ssh_call(server, ["podman"] + cmd, console, quiet=not console)
+        return ssh_call(
+            server, ["podman"] + cmd, console, quiet=not console, timeout=timeout
+        )
     except OSError:
         raise HealthException(
             "podman is required {}".format("on " + server if server else "")
         )
 
 
+@functools.lru_cache(maxsize=None)
+def _get_template(name):
+    """
+    Load a template of the package data, compiling it only once
+
+    :param name: the path of the template relative to the package folder
+    """
+    # The templates are shipped with the package: no need to watch for changes
+    env = Environment(loader=FileSystemLoader(PACKAGE_DIR), auto_reload=False)
+    return env.get_template(name)
+
+
 def render_promtail_cfg(supportconfig_path=None):
     """
     Render promtail configuration file
 
     :param supportconfig_path: render promtail configuration based on this path to a supportconfig
     """
-    loader = FileSystemLoader(os.path.join(os.path.dirname(__file__), "promtail"))
-    env = Environment(loader=loader)
-    template = env.get_template("promtail.yaml.j2")
-    promtail_cfg = os.path.join(os.path.dirname(__file__), "promtail", "promtail.yaml")
+    template = _get_template("promtail/promtail.yaml.j2")
+    promtail_cfg = os.path.join(PACKAGE_DIR, "promtail", "promtail.yaml")
 
     if supportconfig_path:
         opts = {
@@ -116,14 +289,8 @@ def render_promtail_cfg(supportconfig_path=None):
 
 
 def render_supportconfig_exporter_cfg(supportconfig_path=None):
-    loader = FileSystemLoader(
-        os.path.join(os.path.dirname(__file__), "supportconfig_exporter")
-    )
-    env = Environment(loader=loader)
-    template = env.get_template("config.yml.j2")
-    exporter_cfg = os.path.join(
-        os.path.dirname(__file__), "supportconfig_exporter", "config.yml"
-    )
+    template = _get_template("supportconfig_exporter/config.yml.j2")
+    exporter_cfg = os.path.join(PACKAGE_DIR, "supportconfig_exporter", "config.yml")
 
     opts = {"supportconfig_path": supportconfig_path}
 